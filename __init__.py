@@ -6,18 +6,31 @@
 """
 
 from trytond.pool import Pool
-from complaint import Type, Complaint, Action, Action_SaleLine, \
-     Action_InvoiceLine
+from complaint import Type, TypeRule, Complaint, Action, Action_SaleLine, \
+     Action_InvoiceLine, ComplaintArchived, ActionArchived, \
+     ActionArchived_SaleLine, ActionArchived_InvoiceLine, ArchiveStart, \
+     Archive, Change, Dashboard
 from sale import Configuration, Sale
 
 
 def register():
     Pool.register(
         Type,
+        TypeRule,
         Complaint,
         Action,
         Action_SaleLine,
         Action_InvoiceLine,
+        ComplaintArchived,
+        ActionArchived,
+        ActionArchived_SaleLine,
+        ActionArchived_InvoiceLine,
+        ArchiveStart,
+        Change,
+        Dashboard,
         Configuration,
         Sale,
         module='sale_complaint', type_='model')
+    Pool.register(
+        Archive,
+        module='sale_complaint', type_='wizard')
@@ -4,16 +4,107 @@
     :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import datetime
+import uuid
 from collections import defaultdict
+from operator import itemgetter
 
+from sql import Cast, Column, Literal, Null, For
+from sql.aggregate import Count, Sum
+from sql.conditionals import Coalesce, Case
+from sql.functions import Substring, Position, Now
+from sql.operators import LessEqual, Concat
+
+from trytond import backend
 from trytond.model import ModelSQL, ModelView, Workflow, fields
+from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pyson import Eval, If, Bool, Id
 from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.transaction import Transaction
 
+try:
+    from psycopg2.errorcodes import LOCK_NOT_AVAILABLE
+except ImportError:
+    LOCK_NOT_AVAILABLE = None
+
+
+__all__ = ['Type', 'TypeRule', 'Complaint', 'Action',
+    'Action_SaleLine', 'Action_InvoiceLine',
+    'ComplaintArchived', 'ActionArchived',
+    'ActionArchived_SaleLine', 'ActionArchived_InvoiceLine',
+    'ArchiveStart', 'Archive', 'Change', 'Dashboard']
+
+
+def move_complaints(complaint_ids, sources, targets):
+    '''
+    Move the rows of the complaints, their actions and action lines from the
+    tables of the sources to the tables of the targets.
+    sources and targets are tuples of Models:
+    (complaint, action, action-sale line, action-invoice line)
+    '''
+    cursor = Transaction().cursor
+    Action = sources[1]
+    action = Action.__table__()
+
+    action_ids = []
+    for sub_ids in grouped_slice(complaint_ids):
+        cursor.execute(*action.select(action.id,
+                where=reduce_ids(action.complaint, list(sub_ids))))
+        action_ids.extend(r[0] for r in cursor.fetchall())
+    source_ids = [complaint_ids, action_ids]
+    for Relation in sources[2:]:
+        relation = Relation.__table__()
+        relation_ids = []
+        for sub_ids in grouped_slice(action_ids):
+            cursor.execute(*relation.select(relation.id,
+                    where=reduce_ids(relation.action, list(sub_ids))))
+            relation_ids.extend(r[0] for r in cursor.fetchall())
+        source_ids.append(relation_ids)
+
+    for Source, Target, ids in zip(sources, targets, source_ids):
+        source = Source.__table__()
+        target = Target.__table__()
+        names = [n for n, f in Target._fields.iteritems()
+            if not hasattr(f, 'set') and n in Source._fields]
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*target.insert(
+                    [Column(target, n) for n in names],
+                    source.select(*[Column(source, n) for n in names],
+                        where=reduce_ids(source.id, list(sub_ids)))))
+    for Source, ids in reversed(zip(sources, source_ids)):
+        source = Source.__table__()
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*source.delete(
+                    where=reduce_ids(source.id, list(sub_ids))))
+
 
-__all__ = ['Type', 'Complaint', 'Action',
-    'Action_SaleLine', 'Action_InvoiceLine']
+def move_references(complaint_ids, source, target):
+    '''
+    Rewrite the origin of the sales referencing the complaints from the
+    source model name to the target model name.
+    '''
+    pool = Pool()
+    Sale = pool.get('sale.sale')
+    cursor = Transaction().cursor
+    sale = Sale.__table__()
+
+    for sub_ids in grouped_slice(complaint_ids):
+        cursor.execute(*sale.update([sale.origin],
+                [Concat(target, Substring(sale.origin,
+                            Position(',', sale.origin)))],
+                where=sale.origin.in_(
+                    ['%s,%s' % (source, i) for i in sub_ids])))
+
+
+def reference_id(column, model):
+    'Return the id of the Reference column when it targets the model'
+    Model = Pool().get(model)
+    return Case((column.like(model + ',%'),
+            Cast(Substring(column, Position(',', column) + Literal(1)),
+                Model.id.sql_type().base)),
+        else_=Null)
 
 
 class Type(ModelSQL, ModelView):
@@ -24,6 +115,184 @@ class Type(ModelSQL, ModelView):
     origin = fields.Many2One('ir.model', 'Origin', required=True,
         domain=[('model', 'in', ['sale.sale', 'sale.line',
                     'account.invoice', 'account.invoice.line'])])
+    rules = fields.One2Many('sale.complaint.type.rule', 'type',
+        'Approval Rules',
+        help='Waiting complaints matching one of the rules are approved '
+        'automatically')
+
+
+class TypeRule(ModelSQL, ModelView):
+    'Customer Complaint Approval Rule'
+    __name__ = 'sale.complaint.type.rule'
+
+    type = fields.Many2One('sale.complaint.type', 'Type', required=True,
+        ondelete='CASCADE', select=True)
+    sequence = fields.Integer('Sequence')
+    name = fields.Char('Name', required=True)
+    max_amount = fields.Numeric('Maximum Amount', digits=(16, 2),
+        help='The maximum untaxed amount of the origin\n'
+        'Leave empty for no limit')
+    currency = fields.Many2One('currency.currency', 'Currency',
+        states={
+            'required': Eval('max_amount', None) != None,  # noqa: E711
+            'invisible': Eval('max_amount', None) == None,  # noqa: E711
+            },
+        depends=['max_amount'],
+        help='Only the origins in this currency match the maximum amount')
+    max_complaints = fields.Integer('Maximum Complaints',
+        help='The maximum number of other complaints of the customer\n'
+        'Leave empty for no limit')
+    history_days = fields.Integer('History Days',
+        states={
+            'invisible': Eval('max_complaints', None) == None,  # noqa: E711
+            },
+        depends=['max_complaints'],
+        help='The number of days of complaints history to consider\n'
+        'Leave empty for the whole history')
+    max_origin_age = fields.Integer('Maximum Origin Age',
+        help='The maximum number of days since the origin date\n'
+        'Leave empty for no limit')
+    auto_process = fields.Boolean('Process',
+        help='Process the approved complaints directly')
+
+    @classmethod
+    def __setup__(cls):
+        super(TypeRule, cls).__setup__()
+        cls._order.insert(0, ('sequence', 'ASC'))
+
+    @staticmethod
+    def order_sequence(tables):
+        table, _ = tables[None]
+        return [table.sequence == Null, table.sequence]
+
+    @staticmethod
+    def default_currency():
+        pool = Pool()
+        Company = pool.get('company.company')
+        company_id = Transaction().context.get('company')
+        if company_id:
+            return Company(company_id).currency.id
+
+    def match(self, complaint_ids):
+        '''
+        Return the set of complaint ids matching the rule.
+        All the complaints are evaluated with a single query.
+        '''
+        pool = Pool()
+        Complaint = pool.get('sale.complaint')
+        Date = pool.get('ir.date')
+        cursor = Transaction().cursor
+        complaint = Complaint.__table__()
+        batch = Complaint.__table__()
+
+        if not complaint_ids:
+            return set()
+        origin_model = self.type.origin.model
+        today = Date.today()
+
+        origin_ids = batch.select(reference_id(batch.origin, origin_model),
+            where=reduce_ids(batch.id, complaint_ids))
+        origin = self._origin_query(origin_model, origin_ids)
+        query = complaint.join(origin,
+            condition=reference_id(complaint.origin, origin_model)
+            == origin.id)
+        where = reduce_ids(complaint.id, complaint_ids)
+        if self.max_amount is not None:
+            # Decimal is stored as bytes on SQLite
+            type_name = self.__class__.max_amount.sql_type().base
+            where &= ((origin.currency == self.currency.id)
+                & (origin.amount.cast(type_name)
+                    <= Cast(Literal(self.max_amount), type_name)))
+        if self.max_origin_age is not None:
+            where &= origin.date >= (today
+                - datetime.timedelta(days=self.max_origin_age))
+        if self.max_complaints is not None:
+            history = Complaint.__table__()
+            history_where = ((history.customer == complaint.customer)
+                & (history.id != complaint.id)
+                & (history.state != 'cancelled'))
+            if self.history_days is not None:
+                history_where &= history.date >= (today
+                    - datetime.timedelta(days=self.history_days))
+            where &= LessEqual(
+                history.select(Count(Literal(1)), where=history_where),
+                self.max_complaints)
+        cursor.execute(*query.select(complaint.id, where=where))
+        return set(r[0] for r in cursor.fetchall())
+
+    @classmethod
+    def _origin_query(cls, origin_model, origin_ids):
+        '''
+        Return a query on the origin model restricted to the origin_ids
+        sub-query with the columns: id, amount (untaxed), currency and date
+        '''
+        return getattr(cls, '_origin_query_%s'
+            % origin_model.replace('.', '_'))(origin_ids)
+
+    @classmethod
+    def _origin_query_sale_sale(cls, origin_ids):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        sale = Sale.__table__()
+        return sale.select(sale.id,
+            Sale.untaxed_amount_cache.sql_column(sale).as_('amount'),
+            sale.currency.as_('currency'),
+            sale.sale_date.as_('date'),
+            where=sale.id.in_(origin_ids))
+
+    @classmethod
+    def _origin_query_sale_line(cls, origin_ids):
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Line = pool.get('sale.line')
+        sale = Sale.__table__()
+        line = Line.__table__()
+        return line.join(sale, condition=line.sale == sale.id).select(
+            line.id,
+            (Coalesce(line.quantity, 0)
+                * Coalesce(Line.unit_price.sql_column(line), 0)
+                ).as_('amount'),
+            sale.currency.as_('currency'),
+            sale.sale_date.as_('date'),
+            where=line.id.in_(origin_ids))
+
+    @classmethod
+    def _origin_query_account_invoice(cls, origin_ids):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+        invoice = Invoice.__table__()
+        line = Line.__table__()
+
+        amount = line.select(line.invoice.as_('invoice'),
+            Sum(Coalesce(line.quantity, 0)
+                * Coalesce(Line.unit_price.sql_column(line), 0)
+                ).as_('amount'),
+            where=line.invoice.in_(origin_ids),
+            group_by=line.invoice)
+        return invoice.join(amount, 'LEFT',
+            condition=invoice.id == amount.invoice).select(
+            invoice.id,
+            Coalesce(amount.amount, 0).as_('amount'),
+            invoice.currency.as_('currency'),
+            invoice.invoice_date.as_('date'),
+            where=invoice.id.in_(origin_ids))
+
+    @classmethod
+    def _origin_query_account_invoice_line(cls, origin_ids):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        Line = pool.get('account.invoice.line')
+        invoice = Invoice.__table__()
+        line = Line.__table__()
+        return line.join(invoice, condition=line.invoice == invoice.id
+            ).select(line.id,
+            (Coalesce(line.quantity, 0)
+                * Coalesce(Line.unit_price.sql_column(line), 0)
+                ).as_('amount'),
+            invoice.currency.as_('currency'),
+            invoice.invoice_date.as_('date'),
+            where=line.id.in_(origin_ids))
 
 
 class Complaint(Workflow, ModelSQL, ModelView):
@@ -37,9 +306,10 @@ class Complaint(Workflow, ModelSQL, ModelView):
     _depends = ['state']
 
     reference = fields.Char('Reference', readonly=True, select=True)
-    date = fields.Date('Date', states=_states, depends=_depends)
+    date = fields.Date('Date', states=_states, depends=_depends,
+        select=True)
     customer = fields.Many2One('party.party', 'Customer', required=True,
-        states=_states, depends=_depends)
+        states=_states, depends=_depends, select=True)
     address = fields.Many2One('party.address', 'Address',
         domain=[('party', '=', Eval('customer'))],
         states=_states, depends=_depends + ['customer'])
@@ -75,6 +345,7 @@ class Complaint(Workflow, ModelSQL, ModelView):
             ('done', 'Done'),
             ('cancelled', 'Cancelled'),
         ], 'State', readonly=True, required=True)
+    _archive_chunk = 10000
 
     @classmethod
     def __setup__(cls):
@@ -85,6 +356,8 @@ class Complaint(Workflow, ModelSQL, ModelView):
                 'to be deleted.'),
             'invalid_origin': "The Origin on record %s is not valid "
                 "according to its domain.",
+            'complaint_locked': ('The complaints are being processed by '
+                'another user. Try again later.'),
         })
         cls._transitions |= set((
                 ('draft', 'waiting'),
@@ -208,6 +481,7 @@ class Complaint(Workflow, ModelSQL, ModelView):
         pool = Pool()
         Sequence = pool.get('ir.sequence')
         Configuration = pool.get('sale.configuration')
+        Change = pool.get('sale.complaint.change')
 
         vlist = [v.copy() for v in vlist]
         for values in vlist:
@@ -215,7 +489,19 @@ class Complaint(Workflow, ModelSQL, ModelView):
                 config = Configuration(1)
                 values['reference'] = Sequence.get_id(
                     config.complaint_sequence.id)
-        return super(Complaint, cls).create(vlist)
+        complaints = super(Complaint, cls).create(vlist)
+        Change.add('create', complaints)
+        return complaints
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Change = pool.get('sale.complaint.change')
+        super(Complaint, cls).write(*args)
+        actions = iter(args)
+        for complaints, values in zip(actions, actions):
+            Change.add('transition' if 'state' in values else 'write',
+                complaints)
 
     @classmethod
     def copy(cls, complaints, default=None):
@@ -227,9 +513,12 @@ class Complaint(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def delete(cls, complaints):
+        pool = Pool()
+        Change = pool.get('sale.complaint.change')
         for complaint in complaints:
             if complaint.state != 'draft':
                 cls.raise_user_error('delete_draft', complaint.rec_name)
+        Change.add('delete', complaints)
         super(Complaint, cls).delete(complaints)
 
     @classmethod
@@ -246,10 +535,41 @@ class Complaint(Workflow, ModelSQL, ModelView):
 
     @classmethod
     @ModelView.button
-    @Workflow.transition('waiting')
     def wait(cls, complaints):
+        cls.set_waiting(complaints)
+        cls.auto_approve(complaints)
+
+    @classmethod
+    @Workflow.transition('waiting')
+    def set_waiting(cls, complaints):
         pass
 
+    @classmethod
+    def auto_approve(cls, complaints):
+        '''
+        Approve the waiting complaints matching an approval rule of their
+        type. Each rule is evaluated once for the whole batch.
+        '''
+        type2ids = defaultdict(set)
+        for complaint in complaints:
+            if complaint.state == 'waiting':
+                type2ids[complaint.type].add(complaint.id)
+
+        to_approve, to_process = [], []
+        for type_, ids in type2ids.iteritems():
+            for rule in type_.rules:
+                if not ids:
+                    break
+                matched = rule.match(list(ids))
+                ids -= matched
+                to_approve.extend(matched)
+                if rule.auto_process:
+                    to_process.extend(matched)
+        if to_approve:
+            cls.approve(cls.browse(to_approve))
+        if to_process:
+            cls.process(cls.browse(to_process))
+
     @classmethod
     @ModelView.button
     @Workflow.transition('approved')
@@ -264,13 +584,73 @@ class Complaint(Workflow, ModelSQL, ModelView):
 
     @classmethod
     @ModelView.button
-    @Workflow.transition('done')
     def process(cls, complaints):
+        complaints = cls.lock_for_process(complaints)
+        cls.set_done(complaints)
+
+    @classmethod
+    def lock_for_process(cls, complaints):
+        '''
+        Lock the rows of the complaints and their actions until the end of
+        the transaction and return the complaints to process.
+        Depending on the configuration, it fails when a complaint is already
+        locked or it skips it.
+        '''
+        pool = Pool()
+        Action = pool.get('sale.complaint.action')
+        Configuration = pool.get('sale.configuration')
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        cursor = Transaction().cursor
+        complaint = cls.__table__()
+        action = Action.__table__()
+
+        # SQLite locks the whole database on write
+        if backend.name() != 'postgresql' or not complaints:
+            return complaints
+
+        config = Configuration(1)
+        skip_locked = config.complaint_lock_mode == 'skip_locked'
+        complaint_ids = []
+        for sub_ids in grouped_slice([c.id for c in complaints]):
+            where = reduce_ids(complaint.id, list(sub_ids))
+            if skip_locked:
+                # python-sql does not support SKIP LOCKED
+                query, args = tuple(complaint.select(complaint.id,
+                        where=where))
+                cursor.execute(query + ' FOR UPDATE SKIP LOCKED', args)
+                complaint_ids.extend(r[0] for r in cursor.fetchall())
+            else:
+                # The savepoint keeps the transaction usable when the lock
+                # fails, to read the error message and for the callers
+                cursor.execute('SAVEPOINT lock_for_process')
+                try:
+                    cursor.execute(*complaint.select(complaint.id,
+                            where=where, for_=For('UPDATE', nowait=True)))
+                except DatabaseOperationalError, exception:
+                    if exception.pgcode != LOCK_NOT_AVAILABLE:
+                        raise
+                    cursor.execute('ROLLBACK TO SAVEPOINT lock_for_process')
+                    cls.raise_user_error('complaint_locked')
+                complaint_ids.extend(r[0] for r in cursor.fetchall())
+                cursor.execute('RELEASE SAVEPOINT lock_for_process')
+        for sub_ids in grouped_slice(complaint_ids):
+            cursor.execute(*action.select(action.id,
+                    where=reduce_ids(action.complaint, list(sub_ids)),
+                    for_=For('UPDATE')))
+        return cls.browse(complaint_ids)
+
+    @classmethod
+    @Workflow.transition('done')
+    def set_done(cls, complaints):
+        pool = Pool()
+        Action = pool.get('sale.complaint.action')
+        Change = pool.get('sale.complaint.change')
         results = defaultdict(list)
         actions = defaultdict(list)
+        claimed = Action.claim([a for c in complaints for a in c.actions])
         for complaint in complaints:
             for action in complaint.actions:
-                if action.result:
+                if action.result or action not in claimed:
                     continue
                 result = action.do()
                 results[result.__class__].append(result)
@@ -281,6 +661,57 @@ class Complaint(Workflow, ModelSQL, ModelView):
             for action, record in zip(actions[kls], records):
                 action.result = record
                 action.save()
+            Change.add('result', [a.complaint for a in actions[kls]],
+                results=records)
+
+    @classmethod
+    def archive(cls, date):
+        '''
+        Move the closed complaints older than the date with their actions
+        into the archive tables by committed chunks and return their number
+        '''
+        pool = Pool()
+        Action = pool.get('sale.complaint.action')
+        Action_SaleLine = pool.get('sale.complaint.action-sale.line')
+        Action_InvoiceLine = pool.get(
+            'sale.complaint.action-account.invoice.line')
+        ComplaintArchived = pool.get('sale.complaint.archived')
+        ActionArchived = pool.get('sale.complaint.action.archived')
+        ActionArchived_SaleLine = pool.get(
+            'sale.complaint.action.archived-sale.line')
+        ActionArchived_InvoiceLine = pool.get(
+            'sale.complaint.action.archived-account.invoice.line')
+        Change = pool.get('sale.complaint.change')
+        cursor = Transaction().cursor
+        complaint = cls.__table__()
+
+        company_id = Transaction().context.get('company')
+        # Complaints without date are archived on their creation date
+        where = (complaint.state.in_(['done', 'rejected', 'cancelled'])
+            & (complaint.company == company_id)
+            & ((complaint.date < date)
+                | ((complaint.date == Null)
+                    & (complaint.create_date < datetime.datetime.combine(
+                            date, datetime.time())))))
+        count = 0
+        while True:
+            cursor.execute(*complaint.select(complaint.id, where=where,
+                    order_by=[complaint.id.asc],
+                    limit=cls._archive_chunk))
+            complaint_ids = [r[0] for r in cursor.fetchall()]
+            if not complaint_ids:
+                break
+            move_complaints(complaint_ids,
+                (cls, Action, Action_SaleLine, Action_InvoiceLine),
+                (ComplaintArchived, ActionArchived, ActionArchived_SaleLine,
+                    ActionArchived_InvoiceLine))
+            move_references(complaint_ids, cls.__name__,
+                ComplaintArchived.__name__)
+            Change.add_moved('archive', ComplaintArchived, complaint_ids)
+            # Commit each chunk to not hold the locks of all the rows
+            cursor.commit()
+            count += len(complaint_ids)
+        return count
 
     @classmethod
     def validate(cls, records):
@@ -296,18 +727,27 @@ class Complaint(Workflow, ModelSQL, ModelView):
         """
         Validate for correct domain on origin
         """
+        # Search the valid origins once per group of records sharing the
+        # same domain instead of once per record
+        groups = defaultdict(list)
         for record in records:
             if not record.origin_model:
                 continue
+            groups[(record.origin_model, record.customer.id,
+                    record.company.id)].append(record)
 
-            domain = cls._origin_domains(
-                record.customer.id, record.company.id)[record.origin_model]
-            domain += [('id', '=', record.origin_id)]
+        for (model, customer_id, company_id), group in groups.iteritems():
+            domain = cls._origin_domains(customer_id, company_id)[model]
 
-            Model = Pool().get(record.origin_model)
+            Model = Pool().get(model)
 
-            if Model.search(domain, count=True) != 1:
-                cls.raise_user_error('invalid_origin', (record.id,))
+            valid_ids = set()
+            for sub_ids in grouped_slice(set(r.origin_id for r in group)):
+                valid_ids.update(o.id for o in Model.search(
+                        domain + [('id', 'in', list(sub_ids))]))
+            for record in group:
+                if record.origin_id not in valid_ids:
+                    cls.raise_user_error('invalid_origin', (record.id,))
 
 
 class Action(ModelSQL, ModelView):
@@ -326,7 +766,7 @@ class Action(ModelSQL, ModelView):
     _line_depends = _depends
 
     complaint = fields.Many2One('sale.complaint', 'Complaint', required=True,
-        states=_states, depends=_depends)
+        states=_states, depends=_depends, select=True)
     action = fields.Selection([
         ('sale_return', 'Create Sale Return'),
         ('credit_note', 'Create Credit Note'),
@@ -371,6 +811,8 @@ class Action(ModelSQL, ModelView):
         help='Leave empty for the same price')
 
     result = fields.Reference('Result', selection='get_result', readonly=True)
+    idempotency_key = fields.Char('Idempotency Key', readonly=True,
+        select=True, help='The key of the processing which executed it')
 
     @classmethod
     def __setup__(cls):
@@ -380,6 +822,37 @@ class Action(ModelSQL, ModelView):
                 'to be deleted.'),
         })
 
+    @classmethod
+    def copy(cls, actions, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default['idempotency_key'] = None
+        return super(Action, cls).copy(actions, default=default)
+
+    @classmethod
+    def claim(cls, actions):
+        '''
+        Set a new idempotency key on the actions not yet executed and
+        return the set of actions claimed by this key.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        key = uuid.uuid4().hex
+        claimed = set()
+        for sub_actions in grouped_slice(actions):
+            sub_ids = [a.id for a in sub_actions]
+            cursor.execute(*table.update([table.idempotency_key], [key],
+                    where=reduce_ids(table.id, sub_ids)
+                    & (table.idempotency_key == Null)
+                    & (table.result == Null)))
+            cursor.execute(*table.select(table.id,
+                    where=reduce_ids(table.id, sub_ids)
+                    & (table.idempotency_key == key)))
+            claimed.update(cls.browse([r[0] for r in cursor.fetchall()]))
+        return claimed
+
     @fields.depends('complaint')
     def on_change_with_unit(self, name=None):
         if self.complaint.origin_model == 'sale.line':
@@ -497,3 +970,437 @@ class Action_InvoiceLine(ModelSQL):
         ondelete='CASCADE', select=True, required=True)
     line = fields.Many2One('account.invoice.line', 'Invoice Line',
         ondelete='RESTRICT', required=True)
+
+
+class ArchivedMixin(object):
+    '''
+    Prevent to modify the archive which is only filled and emptied by moving
+    the rows of the complaints
+    '''
+
+    @classmethod
+    def __setup__(cls):
+        super(ArchivedMixin, cls).__setup__()
+        cls._error_messages.update({
+                'archived_readonly': 'The archived complaints are read-only.',
+                })
+
+    @classmethod
+    def create(cls, vlist):
+        cls.raise_user_error('archived_readonly')
+
+    @classmethod
+    def write(cls, records, values, *args):
+        cls.raise_user_error('archived_readonly')
+
+    @classmethod
+    def delete(cls, records):
+        cls.raise_user_error('archived_readonly')
+
+
+class ComplaintArchived(ArchivedMixin, ModelSQL, ModelView):
+    'Archived Customer Complaint'
+    __name__ = 'sale.complaint.archived'
+    _rec_name = 'reference'
+
+    reference = fields.Char('Reference', readonly=True, select=True)
+    date = fields.Date('Date', readonly=True, select=True)
+    customer = fields.Many2One('party.party', 'Customer', readonly=True)
+    address = fields.Many2One('party.address', 'Address', readonly=True)
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    employee = fields.Many2One('company.employee', 'Employee',
+        readonly=True)
+    type = fields.Many2One('sale.complaint.type', 'Type', readonly=True)
+    origin = fields.Reference('Origin', selection='get_origin',
+        readonly=True)
+    description = fields.Text('Description', readonly=True)
+    actions = fields.One2Many('sale.complaint.action.archived', 'complaint',
+        'Actions', readonly=True)
+    state = fields.Selection([
+            ('draft', 'Draft'),
+            ('waiting', 'Waiting'),
+            ('approved', 'Approved'),
+            ('rejected', 'Rejected'),
+            ('done', 'Done'),
+            ('cancelled', 'Cancelled'),
+        ], 'State', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ComplaintArchived, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+        cls._buttons.update({
+                'draft': {
+                    'invisible': ~Eval('state').in_(['done', 'cancelled']),
+                    'icon': 'tryton-clear',
+                },
+            }
+        )
+
+    @classmethod
+    def get_origin(cls):
+        pool = Pool()
+        Model = pool.get('ir.model')
+        models = Model.search([
+            ('model', 'in', ['sale.sale', 'sale.line',
+                    'account.invoice', 'account.invoice.line']),
+        ])
+        return [(None, '')] + [(m.model, m.name) for m in models]
+
+    @classmethod
+    @ModelView.button
+    def draft(cls, complaints):
+        """
+        Restore the complaints from the archive and reset them to draft
+        """
+        pool = Pool()
+        Complaint = pool.get('sale.complaint')
+        Action = pool.get('sale.complaint.action')
+        Action_SaleLine = pool.get('sale.complaint.action-sale.line')
+        Action_InvoiceLine = pool.get(
+            'sale.complaint.action-account.invoice.line')
+        ActionArchived = pool.get('sale.complaint.action.archived')
+        ActionArchived_SaleLine = pool.get(
+            'sale.complaint.action.archived-sale.line')
+        ActionArchived_InvoiceLine = pool.get(
+            'sale.complaint.action.archived-account.invoice.line')
+        Change = pool.get('sale.complaint.change')
+
+        complaint_ids = [c.id for c in complaints
+            if (c.state, 'draft') in Complaint._transitions]
+        move_complaints(complaint_ids,
+            (cls, ActionArchived, ActionArchived_SaleLine,
+                ActionArchived_InvoiceLine),
+            (Complaint, Action, Action_SaleLine, Action_InvoiceLine))
+        move_references(complaint_ids, cls.__name__, Complaint.__name__)
+        Change.add_moved('restore', Complaint, complaint_ids)
+        Complaint.draft(Complaint.browse(complaint_ids))
+
+
+class ActionArchived(ArchivedMixin, ModelSQL, ModelView):
+    'Archived Customer Complaint Action'
+    __name__ = 'sale.complaint.action.archived'
+
+    complaint = fields.Many2One('sale.complaint.archived', 'Complaint',
+        ondelete='CASCADE', select=True, readonly=True)
+    action = fields.Selection([
+        ('sale_return', 'Create Sale Return'),
+        ('credit_note', 'Create Credit Note'),
+    ], 'Action', readonly=True)
+    sale_lines = fields.Many2Many('sale.complaint.action.archived-sale.line',
+        'action', 'line', 'Sale Lines', readonly=True)
+    invoice_lines = fields.Many2Many(
+        'sale.complaint.action.archived-account.invoice.line', 'action',
+        'line', 'Invoice Lines', readonly=True)
+    quantity = fields.Float('Quantity', readonly=True)
+    unit_price = fields.Numeric('Unit Price', digits=(16, 4), readonly=True)
+    result = fields.Reference('Result', selection='get_result', readonly=True)
+    idempotency_key = fields.Char('Idempotency Key', readonly=True)
+
+    @classmethod
+    def get_result(cls):
+        pool = Pool()
+        Action = pool.get('sale.complaint.action')
+        return Action.get_result()
+
+
+class ActionArchived_SaleLine(ArchivedMixin, ModelSQL):
+    'Archived Customer Complaint Action - Sale Line'
+    __name__ = 'sale.complaint.action.archived-sale.line'
+
+    action = fields.Many2One('sale.complaint.action.archived', 'Action',
+        ondelete='CASCADE', select=True, required=True)
+    line = fields.Many2One('sale.line', 'Sale Line', ondelete='RESTRICT',
+        required=True)
+
+
+class ActionArchived_InvoiceLine(ArchivedMixin, ModelSQL):
+    'Archived Customer Complaint Action - Invoice Line'
+    __name__ = 'sale.complaint.action.archived-account.invoice.line'
+
+    action = fields.Many2One('sale.complaint.action.archived', 'Action',
+        ondelete='CASCADE', select=True, required=True)
+    line = fields.Many2One('account.invoice.line', 'Invoice Line',
+        ondelete='RESTRICT', required=True)
+
+
+class ArchiveStart(ModelView):
+    'Archive Customer Complaints'
+    __name__ = 'sale.complaint.archive.start'
+
+    date = fields.Date('Date', required=True,
+        help='The closed complaints before this date are archived')
+
+
+class Archive(Wizard):
+    'Archive Customer Complaints'
+    __name__ = 'sale.complaint.archive'
+
+    start = StateView('sale.complaint.archive.start',
+        'sale_complaint.archive_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Archive', 'archive', 'tryton-ok', default=True),
+            ])
+    archive = StateTransition()
+
+    def transition_archive(self):
+        pool = Pool()
+        Complaint = pool.get('sale.complaint')
+        Complaint.archive(self.start.date)
+        return 'end'
+
+
+class Change(ModelSQL, ModelView):
+    'Customer Complaint Change'
+    __name__ = 'sale.complaint.change'
+
+    complaint = fields.Integer('Complaint', required=True, readonly=True,
+        select=True)
+    event = fields.Selection([
+            ('create', 'Create'),
+            ('write', 'Write'),
+            ('delete', 'Delete'),
+            ('transition', 'Transition'),
+            ('result', 'Result'),
+            ('archive', 'Archive'),
+            ('restore', 'Restore'),
+            ], 'Event', required=True, readonly=True)
+    state = fields.Char('State', readonly=True)
+    result = fields.Reference('Result', selection='get_result', readonly=True)
+    transaction = fields.BigInteger('Transaction', required=True,
+        readonly=True, select=True)
+    _pull_limit = 1000
+
+    @classmethod
+    def __setup__(cls):
+        super(Change, cls).__setup__()
+        cls._order.insert(0, ('transaction', 'ASC'))
+        cls._order.insert(1, ('id', 'ASC'))
+        cls.__rpc__.update({
+                'pull': RPC(),
+                })
+
+    @classmethod
+    def get_result(cls):
+        pool = Pool()
+        Action = pool.get('sale.complaint.action')
+        return Action.get_result()
+
+    @staticmethod
+    def current_transaction():
+        '''
+        Return the id of the current database transaction
+        '''
+        if backend.name() == 'postgresql':
+            cursor = Transaction().cursor
+            cursor.execute('SELECT txid_current()')
+            return cursor.fetchone()[0]
+        # The other backends serialize the writing transactions
+        return 0
+
+    @classmethod
+    def add(cls, event, complaints, results=None):
+        """
+        Log the event for the complaints in the current transaction
+        """
+        db_cursor = Transaction().cursor
+        table = cls.__table__()
+
+        if not complaints:
+            return
+        if results is None:
+            results = [None] * len(complaints)
+        transaction = cls.current_transaction()
+        user = Transaction().user
+        # Insert the rows by slices instead of one by one with create
+        values = [[user, Now(), complaint.id, event, complaint.state,
+                str(result) if result else None, transaction]
+            for complaint, result in zip(complaints, results)]
+        for sub_values in grouped_slice(values):
+            db_cursor.execute(*table.insert([
+                        table.create_uid, table.create_date,
+                        table.complaint, table.event, table.state,
+                        table.result, table.transaction,
+                        ], list(sub_values)))
+
+    @classmethod
+    def add_moved(cls, event, Model, complaint_ids):
+        """
+        Log the event for the complaint ids read from the table of Model
+        with one query per slice of ids
+        """
+        db_cursor = Transaction().cursor
+        table = cls.__table__()
+        complaint = Model.__table__()
+
+        if not complaint_ids:
+            return
+        transaction = cls.current_transaction()
+        for sub_ids in grouped_slice(complaint_ids):
+            db_cursor.execute(*table.insert([
+                        table.create_uid, table.create_date,
+                        table.complaint, table.event, table.state,
+                        table.transaction,
+                        ],
+                    complaint.select(
+                        Literal(Transaction().user), Now(),
+                        complaint.id, Literal(event), complaint.state,
+                        Literal(transaction),
+                        where=reduce_ids(complaint.id, list(sub_ids)))))
+
+    @classmethod
+    def pull(cls, cursor=None, limit=_pull_limit):
+        """
+        Return the changes after the cursor and the cursor to use for the
+        next call.
+        The changes are ordered by transaction and id and the cursor is the
+        pair of the last one.
+        """
+        if not limit or limit < 0 or limit > cls._pull_limit:
+            limit = cls._pull_limit
+        transaction, id_ = cursor or (0, 0)
+        domain = [
+            ['OR',
+                ('transaction', '>', transaction),
+                [
+                    ('transaction', '=', transaction),
+                    ('id', '>', id_),
+                    ],
+                ],
+            ]
+        if backend.name() == 'postgresql':
+            # A running transaction may still commit changes, so only the
+            # changes of the transactions older than the oldest running one
+            # are returned. The next changes will be ordered after them.
+            db_cursor = Transaction().cursor
+            db_cursor.execute(
+                'SELECT txid_snapshot_xmin(txid_current_snapshot())')
+            xmin, = db_cursor.fetchone()
+            domain.append(('transaction', '<', xmin))
+        changes = cls.search(domain,
+            order=[('transaction', 'ASC'), ('id', 'ASC')], limit=limit)
+        if changes:
+            transaction, id_ = changes[-1].transaction, changes[-1].id
+        values = cls.read([c.id for c in changes],
+            ['complaint', 'event', 'state', 'result', 'transaction',
+                'create_date'])
+        return {
+            'cursor': [transaction, id_],
+            'changes': sorted(values, key=itemgetter('transaction', 'id')),
+            }
+
+
+class Dashboard(ModelSQL, ModelView):
+    'Customer Complaint Dashboard'
+    __name__ = 'sale.complaint.dashboard'
+
+    complaint = fields.Many2One('sale.complaint', 'Complaint', readonly=True)
+    reference = fields.Char('Reference', readonly=True)
+    date = fields.Date('Date', readonly=True)
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    customer_name = fields.Char('Customer', readonly=True)
+    type_name = fields.Char('Type', readonly=True)
+    origin_name = fields.Char('Origin', readonly=True)
+    state = fields.Selection([
+            ('draft', 'Draft'),
+            ('waiting', 'Waiting'),
+            ('approved', 'Approved'),
+            ('rejected', 'Rejected'),
+            ('done', 'Done'),
+            ('cancelled', 'Cancelled'),
+        ], 'State', readonly=True)
+    action_count = fields.Integer('Actions', readonly=True)
+    result_count = fields.Integer('Results', readonly=True)
+    pending_result_count = fields.Integer('Pending Results', readonly=True,
+        help='The number of results which are not yet done or paid')
+
+    @classmethod
+    def __setup__(cls):
+        super(Dashboard, cls).__setup__()
+        cls._order.insert(0, ('date', 'DESC'))
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Complaint = pool.get('sale.complaint')
+        Action = pool.get('sale.complaint.action')
+        Type = pool.get('sale.complaint.type')
+        Party = pool.get('party.party')
+        Sale = pool.get('sale.sale')
+        SaleLine = pool.get('sale.line')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        complaint = Complaint.__table__()
+        type_ = Type.__table__()
+        party = Party.__table__()
+        sale = Sale.__table__()
+        sale_line = SaleLine.__table__()
+        line_sale = Sale.__table__()
+        invoice = Invoice.__table__()
+        invoice_line = InvoiceLine.__table__()
+        line_invoice = Invoice.__table__()
+
+        origin = complaint.origin
+        query = (complaint
+            .join(party, condition=complaint.customer == party.id)
+            .join(type_, condition=complaint.type == type_.id)
+            .join(sale, 'LEFT',
+                condition=reference_id(origin, 'sale.sale') == sale.id)
+            .join(sale_line, 'LEFT',
+                condition=reference_id(origin, 'sale.line')
+                == sale_line.id)
+            .join(line_sale, 'LEFT',
+                condition=sale_line.sale == line_sale.id)
+            .join(invoice, 'LEFT',
+                condition=reference_id(origin, 'account.invoice')
+                == invoice.id)
+            .join(invoice_line, 'LEFT',
+                condition=reference_id(origin, 'account.invoice.line')
+                == invoice_line.id)
+            .join(line_invoice, 'LEFT',
+                condition=invoice_line.invoice == line_invoice.id))
+
+        # Counts are computed by sub-queries per complaint to use the index
+        # on action.complaint when paging. They are cast because COUNT is a
+        # bigint on PostgreSQL.
+        count = Cast(Count(Literal(1)), cls.action_count.sql_type().base)
+        action = Action.__table__()
+        action_count = action.select(count,
+            where=action.complaint == complaint.id)
+        action = Action.__table__()
+        result_count = action.select(count,
+            where=(action.complaint == complaint.id)
+            & (action.result != Null))
+        action = Action.__table__()
+        result_sale = Sale.__table__()
+        result_invoice = Invoice.__table__()
+        pending_result_count = action.join(result_sale, 'LEFT',
+            condition=reference_id(action.result, 'sale.sale')
+            == result_sale.id
+            ).join(result_invoice, 'LEFT',
+            condition=reference_id(action.result, 'account.invoice')
+            == result_invoice.id
+            ).select(count,
+            where=(action.complaint == complaint.id)
+            & (action.result != Null)
+            & ~Coalesce(result_sale.state, result_invoice.state).in_(
+                ['done', 'paid', 'cancel']))
+
+        return query.select(
+            complaint.id.as_('id'),
+            complaint.create_uid.as_('create_uid'),
+            complaint.create_date.as_('create_date'),
+            complaint.write_uid.as_('write_uid'),
+            complaint.write_date.as_('write_date'),
+            complaint.id.as_('complaint'),
+            complaint.reference.as_('reference'),
+            complaint.date.as_('date'),
+            complaint.company.as_('company'),
+            party.name.as_('customer_name'),
+            type_.name.as_('type_name'),
+            Coalesce(sale.reference, line_sale.reference,
+                invoice.number, line_invoice.number).as_('origin_name'),
+            complaint.state.as_('state'),
+            action_count.as_('action_count'),
+            result_count.as_('result_count'),
+            pending_result_count.as_('pending_result_count'))
@@ -27,6 +27,15 @@ class Configuration:
             ]
         )
     )
+    complaint_lock_mode = fields.Property(
+        fields.Selection([
+                ('nowait', 'Fail'),
+                ('skip_locked', 'Skip'),
+                ], 'Complaint Lock Mode',
+            help='What to do when processing a complaint which is being '
+            'processed by another transaction\n'
+            'Default is to fail')
+    )
 
 
 class Sale:
@@ -45,7 +54,7 @@ class Sale:
     @classmethod
     def _get_origin(cls):
         'Return list of Model names for origin Reference'
-        return ['sale.sale', 'sale.complaint']
+        return ['sale.sale', 'sale.complaint', 'sale.complaint.archived']
 
     @classmethod
     def get_origin(cls):
@@ -6,6 +6,7 @@
 """
 import doctest
 import trytond.tests.test_tryton
+from trytond import backend
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
 
 
@@ -20,4 +21,15 @@ def suite():
             optionflags=doctest.REPORT_ONLY_FIRST_FAILURE
         )
     )
+    # The other backends do not allow concurrent transactions
+    if backend.name() == 'postgresql':
+        suite.addTests(
+            doctest.DocFileSuite(
+                'scenario_sale_complaint_concurrency.rst',
+                setUp=doctest_setup,
+                tearDown=doctest_teardown,
+                encoding='utf-8',
+                optionflags=doctest.REPORT_ONLY_FIRST_FAILURE
+            )
+        )
     return suite